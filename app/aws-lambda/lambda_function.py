@@ -1,14 +1,15 @@
 import time
-import json
 import os
-import logging
 import boto3
 import base64
+import orjson
 
-from datetime import datetime, timedelta
-from boto3.dynamodb.conditions import Key, Attr
-from services.google_ads_service import GoogleAdsService
-from urllib.parse import parse_qsl, unquote
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools.logging.utils import (
+    copy_config_to_registered_loggers,
+)
+from botocore.config import Config
+from urllib.parse import unquote_to_bytes
 
 import services
 import config
@@ -16,280 +17,402 @@ import config
 # .env constants
 TABLE_PREFIX = os.getenv("TABLE_PREFIX", "default")
 CLICK_LOG_TTL_MINUTES = int(os.getenv("CLICK_LOG_TTL_MINUTES", "15"))
+CLICK_LOG_TTL_SECONDS = CLICK_LOG_TTL_MINUTES * 60
 
 # aws resources
-dynamodb = boto3.resource("dynamodb")
-click_log_table = dynamodb.Table(f"{TABLE_PREFIX}_click_logs")
+CLICK_LOG_TABLE = f"{TABLE_PREFIX}_click_logs"
+# sparse index, only unmatched click logs carry pk_unmatched
+UNMATCHED_INDEX = "unmatched-index"
+
+# low-level client skips the resource model load and per-call translation,
+# created once per container so warm invocations reuse the pooled connection
+ddb = boto3.client(
+    "dynamodb",
+    config=Config(
+        tcp_keepalive=True,
+        connect_timeout=1,
+        read_timeout=2,
+        retries={"max_attempts": 2, "mode": "standard"},
+    ),
+)
+
+# services, built on first use from the cached config
+_kommo_service = None
+_google_ads_service = None
+
+# conversion_type query param values, e.g. message_received
+CONVERSION_TYPES = {
+    name.lower(): conversion_type
+    for name, conversion_type in (
+        services.GoogleAdsService.ConversionType.__members__.items()
+    )
+}
+
+# kommo webhook lead id fields
+STATUS_LEAD_ID_FIELD = b"leads[status][0][id]"
+ADD_LEAD_ID_FIELD = b"leads[add][0][id]"
+
+# logger, json lines with 1% of invocations sampled at debug level
+logger = Logger(service="kommo-wa", sampling_rate=0.01)
+copy_config_to_registered_loggers(
+    source_logger=logger,
+    include={"services.kommo_service", "services.google_ads_service"},
+)
 
-# configs
-kommo_config, google_ads_config = config.load_config()
 
-# services
-kommo_service = services.KommoService(config=kommo_config)
-google_ads_service = services.GoogleAdsService(config=google_ads_config)
+def get_kommo_service():
+    """Returns the KommoService, constructing it on first use."""
 
-# logger
-logger = logging.getLogger()
-logger.setLevel("INFO")
+    # lazy singleton, click log requests never touch kommo
+    global _kommo_service
+    if _kommo_service is None:
+        kommo_config, _ = config.load_config()
+        _kommo_service = services.KommoService(config=kommo_config)
+    return _kommo_service
 
 
+def get_google_ads_service():
+    """Returns the GoogleAdsService, constructing it on first use."""
+
+    # lazy singleton, click log requests never touch google ads
+    global _google_ads_service
+    if _google_ads_service is None:
+        _, google_ads_config = config.load_config()
+        _google_ads_service = services.GoogleAdsService(
+            config=google_ads_config
+        )
+    return _google_ads_service
+
+
+@logger.inject_lambda_context(correlation_id_path="requestContext.requestId")
 def lambda_handler(event, context):
-    logger.info("Incoming event: %s", json.dumps(event))
+    # scheduled warmer pings only keep the container alive
+    if event.get("source") == "aws.events" or event.get("warmer"):
+        return _ok("warm")
 
     path = event.get("rawPath", "/")
-    method = event.get("requestContext")["http"]["method"]
+    method = event.get("requestContext", {}).get("http", {}).get("method")
+
+    logger.info("Incoming event", extra={"path": path, "method": method})
+    logger.debug("Incoming event payload", extra={"event": event})
+
+    handler = ROUTES.get((path, method))
+    if handler is None:
+        logger.error("No route for the event.", extra={"path": path})
+        return _not_found("Invalid path")
 
-    if path == "/outbound-click-logs" and method == "POST":
-        return click_log_handler(event)
+    return handler(event)
 
-    if path == "/update-lead" and method == "POST":
-        query_string_params = event.get("queryStringParameters", {})
 
-        conversion_type_key = query_string_params.get("conversion_type")
-        conversion_type = GoogleAdsService.ConversionType[
-            conversion_type_key.upper()
-        ]
+def update_lead_dispatcher(event):
+    query_string_params = event.get("queryStringParameters") or {}
 
-        is_conversion_adjustment = (
-            query_string_params.get("is_adjustment") == "True"
+    conversion_type_key = query_string_params.get("conversion_type") or ""
+    conversion_type = CONVERSION_TYPES.get(conversion_type_key.lower())
+    if conversion_type is None:
+        logger.error("Event object does not have a valid conversion_type.")
+        return _bad_request("Missing or invalid parameter conversion_type")
+
+    is_conversion_adjustment = (
+        query_string_params.get("is_adjustment") == "True"
+    )
+    is_manual_import = query_string_params.get("is_manual") == "True"
+
+    if is_conversion_adjustment:
+        return upload_conversion_adjustment_handler(
+            event=event,
+            conversion_type=conversion_type,
         )
-        is_manual_import = query_string_params.get("is_manual") == "True"
 
-        if is_conversion_adjustment:
-            return upload_conversion_adjustment_handler(
+    if (
+        conversion_type
+        == services.GoogleAdsService.ConversionType.MESSAGE_RECEIVED
+    ):
+        if is_manual_import:
+            return upload_conversion_handler(
                 event=event,
                 conversion_type=conversion_type,
+                is_incoming=True,
             )
+        return update_lead_handler(conversion_type=conversion_type, event=event)
 
-        if conversion_type == GoogleAdsService.ConversionType.MESSAGE_RECEIVED:
-            if is_manual_import:
-                return upload_conversion_handler(
-                    event=event,
-                    conversion_type=conversion_type,
-                    lead_id=extract_incoming_lead_id(event),
-                )
-            return update_lead_handler(
-                conversion_type=conversion_type, event=event
-            )
+    return upload_conversion_handler(
+        event=event, conversion_type=conversion_type
+    )
 
-        return upload_conversion_handler(
-            event=event, conversion_type=conversion_type
-        )
 
-    return {"statusCode": 404, "message": "Invalid path"}
+def click_log_handler(event):
+    try:
+        body = orjson.loads(event["body"]) if event.get("body") else {}
+    except orjson.JSONDecodeError:
+        logger.error("Event body is not valid JSON.")
+        return _bad_request("Request body must be a JSON object")
 
+    if not isinstance(body, dict):
+        logger.error("Event body is not a JSON object.")
+        return _bad_request("Request body must be a JSON object")
 
-def click_log_handler(event):
-    body = json.loads(event["body"] or {})
     gclid, gbraid = body.get("gclid"), body.get("gbraid")
 
     if not (gclid or gbraid):
         logger.error("Event object does not have gclid or gbraid field.")
-        return {
-            "statusCode": 400,
-            "message": "Missing required parameter gclid and gbraid",
-        }
+        return _bad_request("Missing required parameter gclid and gbraid")
 
     return persist_clicklog_to_db(body)
 
 
 def update_lead_handler(conversion_type, event):
-    response = click_log_table.query(
-        KeyConditionExpression=Key("pk").eq("click"),
-        FilterExpression=Attr("matched").eq(False),
-        ScanIndexForward=False,
-        Limit=1,
-    )
+    try:
+        lead_id = extract_incoming_lead_id(event)
+        if lead_id is None:
+            return _missing_lead_id()
+
+        response = ddb.query(
+            TableName=CLICK_LOG_TABLE,
+            IndexName=UNMATCHED_INDEX,
+            # ttl reaping is eventual, skip expired rows not deleted yet
+            KeyConditionExpression="pk_unmatched = :pk AND expires_at > :now",
+            ExpressionAttributeValues={
+                ":pk": {"S": "click"},
+                ":now": {"N": str(int(time.time()))},
+            },
+            ProjectionExpression="expires_at",
+            ConsistentRead=False,
+            ScanIndexForward=False,
+            Limit=1,
+        )
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception("Unmatched click logs could not be queried.")
+
+        return _err("Unmatched click logs could not be queried.")
+
     return update_lead(
         items=response.get("Items", []),
         conversion_type=conversion_type,
-        lead_id=extract_incoming_lead_id(event),
+        lead_id=lead_id,
     )
 
 
-def upload_conversion_handler(event, conversion_type, lead_id=None):
-    lead_id = extract_lead_id(event=event) if lead_id is None else lead_id
-
+def upload_conversion_handler(event, conversion_type, is_incoming=False):
     try:
-        google_ads_service.upload_offline_conversion(
-            raw_lead=kommo_service.construct_raw_lead(lead_id=lead_id),
+        lead_id = (
+            extract_incoming_lead_id(event)
+            if is_incoming
+            else extract_lead_id(event)
+        )
+        if lead_id is None:
+            return _missing_lead_id()
+
+        get_google_ads_service().upload_offline_conversion(
+            raw_lead=get_kommo_service().construct_raw_lead(lead_id=lead_id),
             conversion_type=conversion_type,
         )
 
         logger.info(
-            "Successfully uploaded click conversion. Conversion type: %s",
-            conversion_type.conversion_name,
+            "Successfully uploaded click conversion.",
+            extra={"conversion_type": conversion_type.conversion_name},
         )
 
-        return {
-            "statusCode": 200,
-            "message": "Conversion uploaded successfully.",
-        }
-    except RuntimeError as e:
-        logger.error(
-            "Something went wrong while persisting the click log. \
-            Exception: %s",
-            e,
+        return _ok("Conversion uploaded successfully.")
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception(
+            "Something went wrong while uploading the click conversion."
         )
 
-        return {
-            "statusCode": 500,
-            "message": "Something went wrong while persisting the click log.",
-        }
+        return _err(
+            "Something went wrong while uploading the click conversion."
+        )
 
 
 def upload_conversion_adjustment_handler(event, conversion_type):
     try:
         lead_id = extract_incoming_lead_id(event)
-        google_ads_service.upload_offline_conversion_adjustment(
+        if lead_id is None:
+            return _missing_lead_id()
+
+        get_google_ads_service().upload_offline_conversion_adjustment(
             conversion_type=conversion_type, lead_id=lead_id
         )
         logger.info(
-            "Successfully uploaded click conversion adjustment. Conversion type: %s",
-            conversion_type.conversion_name,
+            "Successfully uploaded click conversion adjustment.",
+            extra={"conversion_type": conversion_type.conversion_name},
         )
 
-        return {
-            "statusCode": 200,
-            "message": "Conversion adjustment uploaded successfully.",
-        }
-    except RuntimeError as e:
-        logger.error(
-            "Something went wrong while uploading the click conversion adjustment. \
-            Exception: %s",
-            e,
+        return _ok("Conversion adjustment uploaded successfully.")
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception(
+            "Something went wrong while uploading the click conversion adjustment."
         )
 
-        return {
-            "statusCode": 500,
-            "message": "Something went wrong while uploading the click conversion adjustment.",
-        }
+        return _err(
+            "Something went wrong while uploading the click conversion adjustment."
+        )
 
 
 def persist_clicklog_to_db(event):
-    created_at = datetime.now()
-    expires_at = created_at + timedelta(minutes=CLICK_LOG_TTL_MINUTES)
+    created_at = int(time.time())
+    expires_at = created_at + CLICK_LOG_TTL_SECONDS
 
     try:
-        click_log_table.put_item(
+        # kept synchronous, lambda freezes the container after returning so a
+        # background write could land after the lead it should be matched to
+        ddb.put_item(
+            TableName=CLICK_LOG_TABLE,
             Item={
-                "pk": "click",
-                "page_path": event.get("page_path"),
-                "gclid": event.get("gclid"),
-                "gbraid": event.get("gbraid"),
-                "created_at": int(created_at.timestamp()),
-                "expires_at": int(expires_at.timestamp()),
-                "matched": False,
-            }
+                "pk": {"S": "click"},
+                "pk_unmatched": {"S": "click"},
+                "page_path": _string_attr(event.get("page_path")),
+                "gclid": _string_attr(event.get("gclid")),
+                "gbraid": _string_attr(event.get("gbraid")),
+                "created_at": {"N": str(created_at)},
+                "expires_at": {"N": str(expires_at)},
+                "matched": {"BOOL": False},
+            },
         )
 
         logger.info(
-            "Successfully persisted click log into table. gclid:%s",
-            event.get("gclid"),
+            "Successfully persisted click log into table.",
+            extra={"gclid": event.get("gclid")},
         )
 
-        return {
-            "statusCode": 200,
-            "message": "Click log persisted successfully.",
-        }
-    except RuntimeError as e:
-        logger.error(
-            "Something went wrong while persisting the click log. \
-            Exception: %s",
-            e,
-        )
+        return _ok("Click log persisted successfully.")
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception("Something went wrong while persisting the click log.")
 
-        return {
-            "statusCode": 500,
-            "message": "Something went wrong while persisting the click log.",
-        }
+        return _err("Something went wrong while persisting the click log.")
 
 
 def update_lead(items, conversion_type, lead_id):
-    if not items:
+    # calls stay sequential, the claim picks the cpc or organic branch and
+    # construct_raw_lead reads back the fields kommo update_lead writes
+    try:
+        click_log = claim_click_log(items[0]) if items else None
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception("Click log could not be marked as matched.")
+
+        return _err("Click log could not be marked as matched.")
+
+    if click_log is None:
         try:
-            kommo_service.update_lead(
+            get_kommo_service().update_lead(
                 lead_id=lead_id,
                 source="organic",
             )
 
             logger.info("Lead updated with organic source.")
 
-            return {
-                "statusCode": 200,
-                "message": "Lead updated with organic source.",
-            }
-        except RuntimeError as e:
-            logger.error(
-                "Lead with organic source could not be updated. \
-                         Exception: %s",
-                e,
-            )
+            return _ok("Lead updated with organic source.")
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Lead with organic source could not be updated.")
 
-            return {
-                "statusCode": 500,
-                "message": "Lead with organic source could not be updated.",
-            }
+            return _err("Lead with organic source could not be updated.")
 
-    if datetime.now().timestamp() <= items[0]["expires_at"]:
-        expires_at = items[0]["expires_at"]
-        gclid, gbraid = items[0]["gclid"], items[0].get("gbraid")
-        page_path = items[0]["page_path"]
+    try:
+        get_kommo_service().update_lead(
+            lead_id=lead_id,
+            source="cpc",
+            gclid=click_log.get("gclid", {}).get("S"),
+            gbraid=click_log.get("gbraid", {}).get("S"),
+            page_path=click_log.get("page_path", {}).get("S"),
+        )
 
-        try:
-            click_log_table.update_item(
-                Key={"pk": "click", "expires_at": expires_at},
-                UpdateExpression="SET matched = :matched",
-                ExpressionAttributeValues={":matched": True},
-            )
+        logger.info("Lead updated with cpc source.")
 
-            kommo_service.update_lead(
-                lead_id=lead_id,
-                source="cpc",
-                gclid=gclid,
-                gbraid=gbraid,
-                page_path=page_path,
-            )
+        get_google_ads_service().upload_offline_conversion(
+            raw_lead=get_kommo_service().construct_raw_lead(lead_id=lead_id),
+            conversion_type=conversion_type,
+        )
 
-            logger.info("Lead updated with cpc source.")
+        return _ok("Lead updated with matched gclid.")
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception("Lead with cpc source could not be updated.")
 
-            google_ads_service.upload_offline_conversion(
-                raw_lead=kommo_service.construct_raw_lead(lead_id=lead_id),
-                conversion_type=conversion_type,
-            )
+        return _err("Lead with cpc source could not be updated.")
 
-            return {
-                "statusCode": 200,
-                "message": "Lead updated with matched gclid.",
-            }
-        except RuntimeError as e:
-            logger.error(
-                "Lead with cpc source could not be updated. \
-                         Exception: %s",
-                e,
-            )
 
-            return {
-                "statusCode": 500,
-                "message": "Lead with cpc source could not be updated.",
-            }
+def claim_click_log(item):
+    """Marks the click log as matched if no other invocation did it first.
 
+    Args:
+        item(dict): click log key attributes returned by the unmatched query.
+
+    Returns:
+        Click log attributes before the update, None if already matched.
+    """
+    try:
+        response = ddb.update_item(
+            TableName=CLICK_LOG_TABLE,
+            Key={"pk": {"S": "click"}, "expires_at": item["expires_at"]},
+            UpdateExpression="SET matched = :matched REMOVE pk_unmatched",
+            ConditionExpression="matched = :unmatched",
+            ExpressionAttributeValues={
+                ":matched": {"BOOL": True},
+                ":unmatched": {"BOOL": False},
+            },
+            ReturnValues="ALL_OLD",
+        )
+    except ddb.exceptions.ConditionalCheckFailedException:
+        logger.info("Click log was already matched by another invocation.")
+        return None
+
+    return response["Attributes"]
+
+
+def _ok(message):
+    return {"statusCode": 200, "message": message}
 
-def extract_lead_id(event):
-    body = event.get("body", {})
 
-    decoded_str = base64.b64decode(body).decode("utf-8")
-    query_str = unquote(decoded_str)
-    payload = dict(parse_qsl(query_str))
+def _bad_request(message):
+    return {"statusCode": 400, "message": message}
 
-    return payload["leads[status][0][id]"]
+
+def _not_found(message):
+    return {"statusCode": 404, "message": message}
+
+
+def _err(message):
+    return {"statusCode": 500, "message": message}
+
+
+def _missing_lead_id():
+    logger.error("Event body does not have a lead id field.")
+    return _bad_request("Missing required lead id")
+
+
+def _string_attr(value):
+    # resource layer stored missing values as NULL, keep the same shape
+    return {"S": value} if value is not None else {"NULL": True}
+
+
+def extract_lead_id(event):
+    return _extract_lead_id(event, STATUS_LEAD_ID_FIELD)
 
 
 def extract_incoming_lead_id(event):
-    body = event.get("body", {})
+    return _extract_lead_id(event, ADD_LEAD_ID_FIELD)
+
+
+def _extract_lead_id(event, field):
+    body = _decode_body(
+        event.get("body") or "", event.get("isBase64Encoded", False)
+    )
+
+    # split before percent-decoding so an encoded "&" inside a value
+    # can not start a new pair, first match wins
+    for pair in body.split(b"&"):
+        key, _, value = pair.partition(b"=")
+        if unquote_to_bytes(key) == field:
+            return unquote_to_bytes(value).decode() or None
+
+    return None
+
+
+def _decode_body(body, is_base64_encoded):
+    return base64.b64decode(body) if is_base64_encoded else body.encode()
 
-    decoded_str = base64.b64decode(body).decode("utf-8")
-    query_str = unquote(decoded_str)
-    payload = dict(parse_qsl(query_str))
 
-    return payload["leads[add][0][id]"]
+# (path, method) -> handler
+ROUTES = {
+    ("/outbound-click-logs", "POST"): click_log_handler,
+    ("/update-lead", "POST"): update_lead_dispatcher,
+}
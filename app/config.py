@@ -1,3 +1,4 @@
+import functools
 import os
 
 
@@ -40,9 +41,12 @@ class GoogleAdsConfig:
         }
 
 
+@functools.lru_cache(maxsize=None)
 def load_config():
     """Loads config objects using env variables.
 
+    The result is cached, so warm invocations reuse the same objects.
+
     Returns Tuple[KommoConfig, GoogleAdsConfig]: KommoConfig and GoogleAdsConfig objects.
 
     Raises:
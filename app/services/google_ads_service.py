@@ -6,7 +6,6 @@ import threading
 from config import GoogleAdsConfig
 from datetime import datetime, timedelta, timezone
 from enum import Enum
-from google.ads.googleads.client import GoogleAdsClient
 
 # logger
 logger = logging.getLogger(__name__)
@@ -57,6 +56,10 @@ class GoogleAdsService:
         if not self._client:
             with self._lock:
                 if not self._client:
+                    # deferred import, grpc and protobuf are slow to load
+                    # pylint: disable-next=import-outside-toplevel
+                    from google.ads.googleads.client import GoogleAdsClient
+
                     self._client = GoogleAdsClient.load_from_dict(
                         self.config.get_config_dict()
                     )
@@ -3,6 +3,8 @@ import logging
 
 from typing import Any
 from config import KommoConfig
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 logger = logging.getLogger(__name__)
@@ -12,6 +14,17 @@ class KommoService:
     def __init__(self, config: KommoConfig):
         self.config = config
 
+        # single pooled session so warm invocations reuse the TLS connection
+        self._session = requests.Session()
+        self._session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=4,
+                max_retries=Retry(total=2, backoff_factor=0.1),
+            ),
+        )
+
     @property
     def _headers(self):
         return {
@@ -30,7 +43,7 @@ class KommoService:
         url = self._build_url(endpoint)
 
         try:
-            response = requests.request(
+            response = self._session.request(
                 method=method.upper(),
                 url=url,
                 params=params,
@@ -135,7 +148,7 @@ class KommoService:
             for id in lead_ids
         ]
 
-        requests.post(url=url, json=body, headers=self._headers)
+        self._session.post(url=url, json=body, headers=self._headers)
 
     def construct_raw_lead(self, lead_id):
         """Returns a dict that contains lead info.